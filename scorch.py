@@ -17,7 +17,11 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['NUMEXPR_MAX_THREADS'] = '1'
 
+# use the oneDNN cpu kernels in tensorflow
+os.environ['TF_ENABLE_ONEDNN_OPTS'] = '1'
+
 # import other libraries
+import re
 import sys
 import math
 import json
@@ -27,6 +31,7 @@ import pickle
 import logging
 import argparse
 import textwrap
+import tempfile
 import contextlib
 import numpy as np
 import pandas as pd
@@ -34,11 +39,12 @@ from tqdm import tqdm
 import xgboost as xgb
 import tensorflow as tf
 from utils.ecifs import *
-from functools import reduce
 from utils import binana, kier
 tf.get_logger().setLevel('ERROR')
 from utils.dock_functions import *
-from functools import partialmethod
+from functools import partial, partialmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from warnings import filterwarnings
 from tensorflow.keras.models import load_model
 from joblib import Parallel, parallel, delayed, load
@@ -49,9 +55,31 @@ from joblib import Parallel, parallel, delayed, load
 # filter pandas warnings
 filterwarnings('ignore')
 
+# let tensorflow fuse operations with XLA
+tf.config.optimizer.set_jit(True)
+
 # get working directory where scoring function is being deployed
 stem_path = os.getcwd()
 
+# pattern for the numeric only lines between poses in pdbqt files
+numeric_line = re.compile(r'^\s*\d+\s*$')
+
+# ECIF headers with the semicolons removed to make valid dataframe headers
+ecif_headers = [header.replace(';','') for header in PossibleECIF]
+
+# load the features the scaler and models expect in the correct order
+reference_headers = json.load(open(os.path.join('utils','params','features.json')))
+scaler_headers_58 = reference_headers.get('for_scaler_58')
+headers_58 = reference_headers.get('492_models_58')
+
+# load the prefitted feature scaler and precompute the inverse of its
+# scale for the model features only, in model header order, so scaling
+# is a single float32 multiply
+maxabs_scaler = load(os.path.join('utils','params','58_maxabs_scaler_params.save'))
+scaler_positions = {header: i for i, header in enumerate(scaler_headers_58)}
+scaler_index_58 = np.array([scaler_positions[header] for header in headers_58], dtype=np.int64)
+inverse_scale_58 = (1.0 / maxabs_scaler.scale_[scaler_index_58]).astype(np.float32)
+
 #######################################################################
 # Functions
 
@@ -91,12 +119,26 @@ def run_binana(ligand_pdbqt_block, receptor_filepath):
     descriptor features as a dictionary     
     """
 
-    # empty dictionary to populate with features
-    binana_features = dict()
-
     # get dictionary of binana features
     main_binana_out = binana.Binana(ligand_pdbqt_block, receptor_filepath).out
 
+    # return the features we want from it
+    return select_binana_features(main_binana_out)
+
+def select_binana_features(main_binana_out):
+
+    """
+    Function: Pick the BINANA descriptors   
+    used for scoring out of the BINANA output
+                                            
+    Inputs:  Dictionary of BINANA output    
+                                            
+    Output: BINANA protein-ligand complex   
+    descriptor features as a dictionary     
+    """
+
+    # empty dictionary to populate with features
+    binana_features = dict()
 
     # define the features we want
     keep_closest_contacts = ["2.5 (HD, OA)", 
@@ -288,22 +330,15 @@ def calculate_ecifs(ligand_pdbqt_block, receptor_filepath):
     receptor pdbqt filepath                 
                                             
     Output: ECIF protein-ligand complex     
-    descriptor features as a pandas DataFrame      
+    descriptor features as an array         
     """
 
     # get ECIFs with default cutoff using imported functions
     # from utils/ecifs.py
     ECIF_data = GetECIF(receptor_filepath, ligand_pdbqt_block, distance_cutoff=6.0)
 
-    # replace the semicolons to make valid dataframe headers
-    ECIFHeaders = [header.replace(';','') for header in PossibleECIF]
-
-    # zip into a dictionary and convert to dataframe
-    ECIF_data = dict(zip(ECIFHeaders,ECIF_data))
-    ECIF_df = pd.DataFrame(ECIF_data,index=[0])
-
-    # return the dataframe
-    return ECIF_df
+    # return the counts as an array
+    return np.array(ECIF_data, dtype=np.float32)
 
 def extract(ligand_pdbqt_block, receptor_filepath):
 
@@ -315,196 +350,353 @@ def extract(ligand_pdbqt_block, receptor_filepath):
     receptor pdbqt filepath     
                                             
     Output: All protein-ligand complex      
-    descriptor features as a DataFrame      
+    descriptor features as a single row     
+    array                                   
     """
     # get the kier flexibility
     k = kier_flexibility(ligand_pdbqt_block)
 
-    # get the binana descriptors and build into dataframe
+    # get the binana descriptors
     binana_dict = run_binana(ligand_pdbqt_block,receptor_filepath)
-    binana_df = pd.DataFrame([binana_dict])
 
     # get the ECIFs
     ECIF = calculate_ecifs(ligand_pdbqt_block, receptor_filepath)
 
-    # concatenate all feature columns to one row dataframe
-    df = pd.concat([ECIF,binana_df],axis=1)
+    # fill one preallocated row with all the feature columns,
+    # with missing binana features as NaN
+    n_ecif = len(ECIF)
+    features = np.empty(n_ecif + len(binana_dict) + 1, dtype=np.float32)
+    features[:n_ecif] = ECIF
+    features[n_ecif:-1] = [np.nan if value is None else value for value in binana_dict.values()]
 
-    # add the kier flexibility as a column
-    df['Kier Flexibility'] = k
+    # add the kier flexibility as the last column
+    features[-1] = k
 
     # return the features
-    return df
+    return features
 
-def prune_df_headers(df):
+def model_feature_index(headers):
 
     """
-    Function: Condense features for model input                             
+    Function: Get the positions of the model
+    features in a row of all features       
                                             
-    Inputs: Full Dataframe of               
-    protein-ligand complex descriptors     
+    Inputs: List of all feature headers     
                                             
-    Output: DataFrame of features for model input                                   
+    Output: Array of model feature positions
     """
 
-    # load features we want in the correct order
-    reference_headers = json.load(open(os.path.join('utils','params','features.json')))
-    headers_58 = reference_headers.get('492_models_58')
-
-    # subset the dataframe of features
-    df = df[headers_58]
+    # map each header to its position and look up the model features
+    positions = {header: i for i, header in enumerate(headers)}
+    return np.array([positions[header] for header in headers_58], dtype=np.int64)
 
-    # return the dataframe
-    return df
-
-def multiple_pose_check(ligand_filepath):
+def prune_features(features):
 
     """
-    Function: Transform ligand.pdbqt file of      
-    poses/models into pdbqt string blocks   
+    Function: Condense features for model input                             
                                             
-    Inputs: ligand.pdbqt filepath           
+    Inputs: Single row array of protein-ligand
+    complex descriptors                     
                                             
-    Output: List of model/pose pdbqt string 
-    blocks as a tuple with the pose number
-    e.g. [('_pose_1','REMARK....)]                                 
+    Output: Array of features for model input                                   
+    """
+
+    # subset the features in the model order
+    return features[model_index_58]
+
+# the positions of the model features in a row of all features, found
+# once as the row is always the ECIFs, the binana features and then
+# the kier flexibility, with the binana feature names taken from an
+# empty binana output
+model_index_58 = model_feature_index(ecif_headers + list(select_binana_features(defaultdict(dict))) + ['Kier Flexibility'])
+
+def split_pdbqt_poses(lig_text, first_pose_only=False):
+
+    """
+    Function: Split the text of a ligand.pdbqt file
+              of poses/models into clean pdbqt string
+              blocks
+
+    Inputs:   Ligand pdbqt file text, whether to stop
+              after the first pose
+
+    Output:   List of pose pdbqt string blocks
     """
 
     # make empty list for populating
     pdbqt_pose_blocks = list()
 
-    # open the input ligand file
-    lig_text = open(ligand_filepath, 'r').read()
-
     # split by poses
-    lig_poses = lig_text.split('MODEL')
-
-    # for each pose clean up any whitespace or empty lines
-    for pose in lig_poses:
+    for pose in lig_text.split('MODEL'):
         if "AutoDock-GPU version" in pose:
             continue
-        lines = pose.split('\n')
+
+        # clean up any whitespace or empty lines in the pose
         clean_lines = []
-        # clean_lines = [line for line in lines if not line.strip().lstrip().isnumeric() and 'ENDMDL' not in line]
-        for line in lines:
+        for line in pose.split('\n'):
             if 'ENDMDL' in line or 'DOCKED: TER' in line:
                 clean_lines.append("")
                 break
 
-            if not line.strip().lstrip().isnumeric() and "DOCKED: USER" not in line:
+            if not numeric_line.match(line) and "DOCKED: USER" not in line:
                 clean_lines.append(line.replace('DOCKED: ', ""))
 
         # if there are less than three lines then
-        # its an artefact of the splitting and we ignore 
-        if len(clean_lines) < 3:
-            pass
-
+        # its an artefact of the splitting and we ignore
         # otherwise join up the correct poses
-        else:
-            pose = '\n'.join(clean_lines)
-
-            # add the pose to the list of poses
-            pdbqt_pose_blocks.append(pose)
+        if len(clean_lines) >= 3:
+            pdbqt_pose_blocks.append('\n'.join(clean_lines))
 
-    # map the poses into a list of tuples
-    pdbqt_pose_blocks = list(map(lambda x: (f'_pose_{pdbqt_pose_blocks.index(x) + 1}', x), pdbqt_pose_blocks))
+            # stop if we only want one pose
+            if first_pose_only:
+                break
 
-    # return the list of tuples
+    # return the list of poses
     return pdbqt_pose_blocks
 
-def run_networks(df, models_to_load, model_name):
+def multiple_pose_check(ligand_filepath):
+
+    """
+    Function: Transform ligand.pdbqt file of      
+    poses/models into pdbqt string blocks   
+                                            
+    Inputs: ligand.pdbqt filepath           
+                                            
+    Output: List of model/pose pdbqt string 
+    blocks as a tuple with the pose number
+    e.g. [('_pose_1','REMARK....)]                                 
+    """
+
+    # open the input ligand file and split it into poses
+    lig_text = open(ligand_filepath, 'r').read()
+    pdbqt_pose_blocks = split_pdbqt_poses(lig_text)
+
+    # return the poses as a list of tuples with their pose numbers
+    return [(f'_pose_{i + 1}', pose) for i, pose in enumerate(pdbqt_pose_blocks)]
+
+def run_networks(df, ensemble, model_name):
 
     """
     Function: Get single mean prediction from consensus of 
     neural network models for a protein-ligand complex              
                                             
     Inputs: Dataframe of features for model,
-            list of model filenames to load,
+            fused ensemble graph of the networks,
             model name string for prediction columns
 
     Output: Dataframe of model predictions with 
             final average mean column              
     """
 
-    # make empty dataframe to populate wit predictions
-    predictions = pd.DataFrame()
-
-    # for each model
-    for i in tqdm(range(len(models_to_load))):
+    # convert the features to a float32 array
+    x = df.to_numpy(dtype=np.float32)
 
-        # load the model and get its prediction on the data
-        model = load_model(models_to_load[i])
-        y_pred = model.predict(df)
+    # get the predictions of every network in the ensemble
+    # and their average from a single call to the fused graph
+    predictions, average = ensemble(x)
 
-        # add the prediction as a column to the predictions df
-        predictions[f'{model_name}_{i + 1}'] = y_pred.flatten()
+    # build the predictions dataframe in one go
+    predictions = np.asarray(predictions)
+    model_columns = [f'{model_name}_{i + 1}' for i in range(predictions.shape[1])]
+    predictions = pd.DataFrame(predictions, columns=model_columns)
 
-    # take an average of all the predictions
-    predictions[f'{model_name}_models_average'] = predictions.mean(axis=1)
+    # add the average of all the predictions
+    predictions[f'{model_name}_models_average'] = np.asarray(average)
 
     # return the df of predictions
     return predictions
 
-
-def binary_concat(dfs, headers):
+def fuse_networks(model_filepaths, n_features):
 
     """
-    Function: Concatenate list of           
-    dataframes into a single dataframe by   
-    sequentially writing to a single binary 
-    file (removes pd.concat bottleneck)     
-                                            
-    Inputs: List of dataframes, dataframe   
-    headers as a list                       
-                                            
-    Output: Single combined dataframe       
+    Function: Load neural network model binaries and
+              stack their weights into one batched graph
+              so the whole ensemble runs in a single pass.
+              Hidden layers of different widths are zero
+              padded to the widest model, ReLU and ELU
+              activations are both expressed as an ELU
+              with a per-model alpha (0 for ReLU), and
+              wide & deep models get their input added
+              straight into the output layer
+
+    Inputs:   List of model hdf5 filepaths, number of
+              input features the models expect
+
+    Output:   Callable graph returning the predictions
+              of each model and their average for a
+              float32 tensor
     """
 
-    # set total rows count
-    total_rows = 0
+    # empty lists to populate with the weights of each model
+    hidden_weights, output_weights, wide_weights = list(), list(), list()
 
-    # make temporary directory for binary file if it
-    # doesn't exist yet
-    if not os.path.isdir(os.path.join('utils','temp')):
-        os.makedirs(os.path.join('utils','temp'))
-
-    # create a temporary binary file
-    with open(os.path.join('utils','temp','features.bin'),'wb+') as binary_store:
-
-        # then for each dataframe write it to binary
-        for df in dfs:
-
-            # make sure nRot is numeric in type
-            df['nRot'] = pd.to_numeric(df['nRot'])
-
-            # get the rows and columns of the dataframe
-            rows, fixed_total_columns = df.shape
-
-            # add the rows to total rows counter
-            total_rows += rows
-
-            # write the df to the binary store file
-            binary_store.write(df.values.tobytes())
-
-            # store the dtypes
-            typ = df.values.dtype
-
-    # open the temporary binary file
-    with open(os.path.join('utils','temp','features.bin'),'rb') as binary_store:
-
-        # read the binary file
-        buffer = binary_store.read()
-
-        # shape the data into a dataframe using the info from
-        # when we wrote all the files to the binary store
-        data = np.frombuffer(buffer, dtype=typ).reshape(total_rows, fixed_total_columns)
-        master_df = pd.DataFrame(data = data, columns = headers)
+    # for each model
+    for model_filepath in model_filepaths:
+
+        # load the model without the training configuration
+        model = load_model(model_filepath, compile=False)
+
+        # get the dense layers, activations and whether it is a wide & deep model
+        dense_layers = [layer for layer in model.layers if isinstance(layer, tf.keras.layers.Dense)]
+        activations = [layer for layer in model.layers if isinstance(layer, (tf.keras.layers.ReLU, tf.keras.layers.ELU))]
+        concatenates = [layer for layer in model.layers if isinstance(layer, tf.keras.layers.Concatenate)]
+        wide = bool(concatenates)
+
+        # make sure the model has the architecture the fused graph
+        # reproduces, as anything else would silently give wrong scores
+        fused_layer_types = (tf.keras.layers.InputLayer, tf.keras.layers.Dense, tf.keras.layers.ReLU,
+                             tf.keras.layers.ELU, tf.keras.layers.Dropout, tf.keras.layers.Concatenate)
+        unfused_layers = [layer.name for layer in model.layers if type(layer) not in fused_layer_types]
+        if unfused_layers:
+            raise ValueError(f'{model_filepath}: can only fuse InputLayer, Dense, ReLU, ELU, Dropout and Concatenate layers, not {unfused_layers}')
+        if any(layer.max_value is not None or layer.negative_slope != 0 or layer.threshold != 0
+               for layer in activations if isinstance(layer, tf.keras.layers.ReLU)):
+            raise ValueError(f'{model_filepath}: expected ReLU layers without max_value, negative_slope or threshold')
+        if not activations or len(activations) != len(dense_layers) - 1:
+            raise ValueError(f'{model_filepath}: expected one ReLU or ELU layer after each hidden Dense layer')
+        if any(layer.activation is not tf.keras.activations.linear for layer in dense_layers[:-1]):
+            raise ValueError(f'{model_filepath}: expected hidden Dense layers with a linear activation')
+        if dense_layers[-1].activation is not tf.keras.activations.sigmoid:
+            raise ValueError(f'{model_filepath}: expected a Dense output layer with a sigmoid activation')
+        if hidden_weights and len(activations) != len(hidden_weights[0]):
+            raise ValueError(f'{model_filepath}: expected {len(hidden_weights[0])} hidden layers like the other models in the ensemble')
+        if wide:
+            inbound_layers = concatenates[0].inbound_nodes[0].inbound_layers
+            if (len(concatenates) != 1 or len(inbound_layers) != 2
+                or inbound_layers[0] is not activations[-1]
+                or not isinstance(inbound_layers[1], tf.keras.layers.Dropout)):
+                raise ValueError(f'{model_filepath}: expected the wide & deep layers to be concatenated as (last activation, input dropout)')
+
+        # store each hidden layer kernel and bias with its activation alpha
+        hidden_weights.append([(*layer.get_weights(), float(activation.alpha) if isinstance(activation, tf.keras.layers.ELU) else 0.0)
+                               for layer, activation in zip(dense_layers[:-1], activations)])
+
+        # split the output kernel into its deep and wide inputs
+        kernel, bias = dense_layers[-1].get_weights()
+        deep_width = hidden_weights[-1][-1][0].shape[1]
+        output_weights.append((kernel[:deep_width], bias))
+        wide_weights.append(kernel[deep_width:] if wide else np.zeros((n_features, 1), dtype=np.float32))
+
+    # stack the hidden layer weights into (models, in_dim, out_dim) and
+    # (models, out_dim) arrays, zero padding to the widest model
+    kernels, biases, alphas = list(), list(), list()
+    for layer_weights in zip(*hidden_weights):
+        in_dim = max(kernel.shape[0] for kernel, bias, alpha in layer_weights)
+        out_dim = max(kernel.shape[1] for kernel, bias, alpha in layer_weights)
+        stacked_kernel = np.zeros((len(layer_weights), in_dim, out_dim), dtype=np.float32)
+        stacked_bias = np.zeros((len(layer_weights), out_dim), dtype=np.float32)
+        for i, (kernel, bias, alpha) in enumerate(layer_weights):
+            stacked_kernel[i, :kernel.shape[0], :kernel.shape[1]] = kernel
+            stacked_bias[i, :bias.shape[0]] = bias
+        kernels.append(stacked_kernel)
+        biases.append(stacked_bias)
+        alphas.append(np.array([[alpha] for kernel, bias, alpha in layer_weights], dtype=np.float32))
+
+    # stack the output layer weights in the same way
+    out_dim = kernels[-1].shape[2]
+    output_kernel = np.zeros((len(output_weights), out_dim, 1), dtype=np.float32)
+    for i, (kernel, bias) in enumerate(output_weights):
+        output_kernel[i, :kernel.shape[0]] = kernel
+    output_bias = np.stack([bias for kernel, bias in output_weights]).astype(np.float32)
+    wide_kernel = np.stack(wide_weights).astype(np.float32)
+
+    # ELU with a per-model alpha, which is a ReLU when alpha is 0
+    def activation(h, alpha):
+        return tf.nn.relu(h) + (tf.exp(tf.minimum(h, 0.0)) - 1.0) * alpha
+
+    # fused forward pass of the whole ensemble, traced once
+    # with the weights embedded as constants and compiled with XLA
+    @tf.function(input_signature=[tf.TensorSpec([None, n_features], tf.float32)], experimental_compile=True)
+    def ensemble(x):
+
+        # the first layer shares the same input across all the models
+        h = activation(tf.einsum('bi,kij->bkj', x, kernels[0]) + biases[0], alphas[0])
+
+        # the rest of the hidden layers are batched per model
+        for kernel, bias, alpha in zip(kernels[1:], biases[1:], alphas[1:]):
+            h = activation(tf.einsum('bki,kij->bkj', h, kernel) + bias, alpha)
+
+        # output layer with the wide input added in, giving (batch, models)
+        y = tf.einsum('bki,kij->bkj', h, output_kernel) + tf.einsum('bi,kij->bkj', x, wide_kernel) + output_bias
+        y = tf.sigmoid(y[:, :, 0])
+
+        # return the per model predictions and their average
+        return y, tf.reduce_mean(y, axis=1)
+
+    # trace the graph now so it is ready before being
+    # called from any scoring threads
+    ensemble.get_concrete_function()
+
+    # return the fused graph
+    return ensemble
+
+def onnx_networks(ensemble, n_features, tensorrt=False, max_batch_size=1):
 
-    # make sure the binary store is deleted in case we call the function again
-    os.remove(os.path.join('utils','temp','features.bin'))
+    """
+    Function: Convert a fused ensemble graph to ONNX
+              and load it into an ONNX Runtime session,
+              optionally built into a TensorRT engine
+              on the GPU
+
+    Inputs:   Fused ensemble graph, number of input
+              features the models expect, whether to
+              use TensorRT, largest number of poses
+              scored at once
+
+    Output:   Callable returning the predictions of
+              each model and their average for a
+              float32 array
+    """
 
-    # return the concatenated dataframe
-    return master_df
+    # only import the onnx packages if they have been requested
+    try:
+        import tf2onnx
+        import onnxruntime
+    except ImportError:
+        logging.critical("ERROR: ONNX Runtime requested but tf2onnx or onnxruntime is not installed. Try:\n- installing them with pip install tf2onnx onnxruntime\n- running without the --onnx argument")
+        sys.exit()
+
+    # convert the fused graph to an onnx model in memory
+    input_signature = [tf.TensorSpec([None, n_features], tf.float32)]
+    onnx_model, _ = tf2onnx.convert.from_function(ensemble, input_signature=input_signature)
+
+    # run on the cpu unless tensorrt has been requested
+    providers = ['CPUExecutionProvider']
+    if tensorrt:
+
+        # check onnx runtime has been built with tensorrt
+        if 'TensorrtExecutionProvider' not in onnxruntime.get_available_providers():
+            logging.warning('WARNING: TensorRT requested but not available in this onnxruntime install, running NN Models on the CPU')
+
+        # otherwise build fp16 engines for every batch size up to the largest
+        # batch, so the cached engine is reused rather than rebuilt whenever a
+        # bigger batch comes along, and fall back to cuda then cpu for
+        # anything tensorrt can't run
+        else:
+            engine_cache_path = os.path.join('utils','temp','trt_engines')
+            if not os.path.isdir(engine_cache_path):
+                os.makedirs(engine_cache_path)
+            onnx_input = onnx_model.graph.input[0].name
+            providers = [('TensorrtExecutionProvider', {'trt_fp16_enable': True,
+                                                        'trt_engine_cache_enable': True,
+                                                        'trt_engine_cache_path': engine_cache_path,
+                                                        'trt_profile_min_shapes': f'{onnx_input}:1x{n_features}',
+                                                        'trt_profile_opt_shapes': f'{onnx_input}:{max_batch_size}x{n_features}',
+                                                        'trt_profile_max_shapes': f'{onnx_input}:{max_batch_size}x{n_features}'}),
+                         'CUDAExecutionProvider',
+                         'CPUExecutionProvider']
+
+    # load the onnx model into an inference session
+    session = onnxruntime.InferenceSession(onnx_model.SerializeToString(), providers=providers)
+    input_name = session.get_inputs()[0].name
+
+    # run the whole ensemble in one session call, so the features
+    # are only copied to and from the device once per ensemble
+    def onnx_ensemble(x):
+        return session.run(None, {input_name: x})
+
+    # return the onnx ensemble
+    return onnx_ensemble
 
 def parse_module_args(args_dict):
 
@@ -521,7 +713,7 @@ def parse_module_args(args_dict):
     command_input = list()
 
     # check if any boolean flag arguments have been passed
-    boolean_args = ['verbose','return_pose_scores']
+    boolean_args = ['verbose','return_pose_scores','onnx','trt']
     for key, value in args_dict.items():
         if key in boolean_args:
             if value:
@@ -569,6 +761,8 @@ def parse_args(args):
     parser.add_argument('-p','--return_pose_scores', action='store_true', help="If supplied, scoring values for individual poses in each ligand file are returned")
     parser.add_argument('-v','--verbose', action='store_true', help="If supplied, progress bars and indicators are displayed while scoring")
     parser.add_argument('-s','--pose_1', action='store_true', help="Consider only the first pose in each pdbqt file to score - NOT RECOMMENDED")
+    parser.add_argument('-x','--onnx', action='store_true', help="If supplied, the neural network models are run with ONNX Runtime (requires the tf2onnx and onnxruntime packages)")
+    parser.add_argument('-trt','--trt', action='store_true', help="If supplied, the neural network models are run as TensorRT engines on the GPU through ONNX Runtime (requires tf2onnx and onnxruntime-gpu built with TensorRT)")
     parser.add_argument('-d','--dock', action='store_true', help="""If supplied, input ligands are assumed to be text SMILES and will be docked 
                                                                     using GWOVina before scoring. This will be autodetected if a .smi or .txt file is supplied""")
     params = parser.parse_args()
@@ -580,7 +774,7 @@ def parse_args(args):
         logging.basicConfig(level=logging.WARNING, format='%(message)s')
 
     if os.path.isdir(params.ligand):
-        params.ligand = [os.path.join(params.ligand, file) for file in os.listdir(params.ligand)]
+        params.ligand = [entry.path for entry in os.scandir(params.ligand) if entry.is_file()]
         receptors = [params.receptor for i in range(len(params.ligand))]
         params.receptor = receptors
 
@@ -713,7 +907,7 @@ def prepare_and_dock_inputs(params):
     docked_ligands_path = os.path.join('docked_ligands',docked_ligands_folder,'')
 
     # add each docked ligand in temp file as a ligand to score to the list of ligands in params.ligand
-    params.ligand = [os.path.join('utils','temp','docked_pdbqt_files', file) for file in os.listdir(os.path.join('utils','temp','docked_pdbqt_files'))]
+    params.ligand = [entry.path for entry in os.scandir(os.path.join('utils','temp','docked_pdbqt_files')) if entry.is_file()]
     
     # build receptor as a repeating list into params dict
     receptors = [params.receptor for i in range(len(params.ligand))]
@@ -794,35 +988,11 @@ def ligand_pose_generator(params, lower_index, upper_index):
             break
 
         # load the poses from the current ligand being considered
-        pdbqt_pose_blocks = list()
         lig_text = open(ligand_filepath, 'r').read()
-        lig_poses = lig_text.split('MODEL')
-        for pose in lig_poses:
-            if "AutoDock-GPU version" in pose:
-                continue
-            lines = pose.split('\n')
-            # clean_lines = [line for line in lines if not line.strip().lstrip().isnumeric() and 'ENDMDL' not in line]
-            clean_lines = []
-            for line in lines:
-                if 'ENDMDL' in line or 'DOCKED: TER' in line:
-                    clean_lines.append("")
-                    break
-
-                if not line.strip().lstrip().isnumeric() and "DOCKED: USER" not in line:
-                    clean_lines.append(line.replace('DOCKED: ', ""))
-
-            if len(clean_lines) < 3:
-                pass
-            else:
-                pose = '\n'.join(clean_lines)
-                pdbqt_pose_blocks.append(pose)
-
-                # stop if we only want one pose
-                if params.pose_1:
-                    break
+        pdbqt_pose_blocks = split_pdbqt_poses(lig_text, params.pose_1)
 
         # make a tuple with pdbqt block and pose name
-        poses = [(f'_pose_{pdbqt_pose_blocks.index(pose) + 1}', pose) for pose in pdbqt_pose_blocks]
+        poses = [(f'_pose_{i + 1}', pose) for i, pose in enumerate(pdbqt_pose_blocks)]
 
         # for each pose
         for pose in poses:
@@ -901,7 +1071,7 @@ def list_to_chunk_indexes(list_length, number_of_chunks):
     # return list of indices
     return indices
 
-def prepare_features(receptor_ligand_args):
+def prepare_features(receptor_ligand_args, feature_store, row_index):
 
     filterwarnings('ignore')
 
@@ -909,10 +1079,11 @@ def prepare_features(receptor_ligand_args):
     Function: Wrapper to prepare all requested protein-ligand            
               complexes/poses for scoring             
                                             
-    Inputs:   A tuple of a receptor ligand pair to score                            
+    Inputs:   A tuple of a receptor ligand pair to score,
+              shared memory mapped feature array and the
+              row of it to write the features into
                                             
-    Output:   A single row dataframe of protein-ligand complex
-              features                      
+    Output:   Tuple of the receptor and ligand names
     """
     # grab the ligand pose number and pdbqt string block
     ligand_pose_number = receptor_ligand_args[2][0]
@@ -928,68 +1099,45 @@ def prepare_features(receptor_ligand_args):
     # extract the interaction features
     features = extract(ligand_pdbqt_block, receptor_filepath)
 
-    # prune the headers down to those needed for model scoring
-    multi_pose_features = prune_df_headers(features)
+    # prune the features down to those needed for model scoring
+    multi_pose_features = prune_features(features)
 
     # fill None values with 0 for binana features
-    multi_pose_features.fillna(0, inplace=True)
+    multi_pose_features[np.isnan(multi_pose_features)] = 0
 
-    # add receptor and ligand info to features
-    multi_pose_features['Receptor'] = receptor_basename
-    multi_pose_features['Ligand'] = ligand_basename
-    
-    # return the dataframe
-    return multi_pose_features
+    # write the features straight into the shared array so
+    # they don't have to be sent back from the worker
+    feature_store[row_index] = multi_pose_features
 
-def scale_multipose_features(df):
+    # return the receptor and ligand info
+    return receptor_basename, ligand_basename
+
+def scale_multipose_features(features):
 
     """
     Function: Scale features using prefitted feature scaler
 
-    Input:    Dataframe of features to scale
+    Input:    Array of features to scale, with columns in
+              the model header order
 
-    Output:   Scaled dataframe of features
+    Output:   Scaled float32 array of features
     """
 
-    # open the reference features file
-    reference_headers = json.load(open(os.path.join('utils','params','features.json')))
-    scaler_58 = reference_headers.get('for_scaler_58')
-    headers_58 = reference_headers.get('492_models_58')
-
-    # store the ligand and receptor information
-    ligands, receptors = df['Ligand'], df['Receptor']
-
-    # get the missing columns that the scaler expects
-    missing_columns = list(set(scaler_58) - set(list(df)))
-
-    # fill in dummy columns for the scaler
-    for col in missing_columns:
-        df[col] = 0
-    df = df[scaler_58]
-
-    # load the scaler and scale the data
-    scaler = load(os.path.join('utils','params','58_maxabs_scaler_params.save'))
-    scaled = scaler.transform(df)
-    df[df.columns] = scaled
+    # the scaler works column by column, so only the scales of the
+    # model features are needed and they are already in the right order
+    return np.multiply(features, inverse_scale_58, dtype=np.float32)
 
-    # then only keep the columns we want for the models
-    df = df[headers_58]
-
-    # add the receptor and ligand info back in
-    df['Ligand'], df['Receptor'] = ligands, receptors
-
-    # return the dataframe
-    return df
-
-def score(models, features):
+def score(models, features, ligand_info):
 
     """
     Function: Score supplied ligands with   
     an individual model                     
                                             
     Inputs: Tuple of (model_name,           
-                      model_binary_file,    
-                      feature dataframes)   
+                      model_binary_file),   
+            dataframe of scaled features,   
+            dataframe of ligand and receptor
+            names for each row of features  
                                             
     Output: Dataframe of model predictions  
     """
@@ -1000,14 +1148,15 @@ def score(models, features):
 
     logging.info(f'Scoring with {model_name}...')
 
-    # create results and features dataframe
-    results = features[['Ligand','Receptor']].copy().reset_index(drop=True)
-    df = features.drop(['Ligand','Receptor'], axis=1)
+    # create results dataframe from the shared ligand and receptor info
+    results = ligand_info.copy()
+    df = features
 
     # get the model scores for each row in the dataframe
     if 'xgb' in model_name:
-        dtest = xgb.DMatrix(df, feature_names=df.columns)
-        results[model_name] = model_file.predict(dtest)
+        # predict straight from a float32 array rather than building a DMatrix
+        features_array = np.ascontiguousarray(df.to_numpy(dtype=np.float32))
+        results[model_name] = model_file.inplace_predict(features_array)
 
     else:
         network_predictions = run_networks(df, model_file, model_name)
@@ -1047,14 +1196,15 @@ def print_intro(params):
 
         logging.info('**************************************************************************\n')
 
-def prepare_models(params):
+def prepare_models(params, max_batch_size):
 
     """
     Function: Loads machine-learning model  
     binaries                                
                                             
     Inputs: User command line parameters    
-    dictionary                              
+    dictionary, largest number of poses     
+    scored at once                          
                                             
     Output: Dictionary of {model_name:      
                            model_binary}    
@@ -1063,28 +1213,59 @@ def prepare_models(params):
     logging.info('\n**************************************************************************\n')
     logging.info('Model Request Summary:\n')
 
+    # if the user asked for more than one thread then run each
+    # tensorflow op across that many threads, one op at a time,
+    # otherwise leave tensorflow to use every core as it does by default
+    if params.threads > 1:
+        try:
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+            tf.config.threading.set_intra_op_parallelism_threads(params.threads)
+
+        # the threads can't be changed once tensorflow has started
+        except RuntimeError:
+            pass
+
     # empty dictionary to store models
     models = {}
 
+    # get the number of features the models expect
+    n_features = len(headers_58)
+
     # load xgboost model
     logging.info('XGBoost Model: Yes')
     xgb_path = os.path.join('utils','models','xgboost_models','495_models_58_booster.pkl')
     models['xgboost_model'] = pickle.load(open(xgb_path,'rb'))
 
+    # use the gpu predictor if a gpu is available and xgboost
+    # was built with cuda, otherwise stay on the cpu predictor
+    if tf.config.list_physical_devices('GPU'):
+        try:
+            models['xgboost_model'].set_param({'predictor': 'gpu_predictor'})
+            models['xgboost_model'].inplace_predict(np.zeros((1, n_features), dtype=np.float32))
+        except xgb.core.XGBoostError:
+            models['xgboost_model'].set_param({'predictor': 'cpu_predictor'})
+
     # load best 15 neural network models for WD models and feedforward models
     logging.info('Feedforward NN Models : Yes')
     models['ff_nn'] = os.path.join('utils','models','ff_nn_models')
     model_ranks = pickle.load(open(os.path.join(models['ff_nn'],'rankings.pkl'),'rb'))
     model_ranks = model_ranks[:15]
-    models['ff_nn'] = [os.path.join(models['ff_nn'], 'models',f'{model[1]}.hdf5') for model in model_ranks]
+    models['ff_nn'] = fuse_networks([os.path.join(models['ff_nn'], 'models',f'{model[1]}.hdf5') for model in model_ranks], n_features)
 
     logging.info('W&D NN Models : Yes')
     models['wd_nn'] = os.path.join('utils','models','wd_nn_models')
     model_ranks = pickle.load(open(os.path.join(models['wd_nn'],'rankings.pkl'),'rb'))
     model_ranks = model_ranks[:15]
-    models['wd_nn'] = [os.path.join(models['wd_nn'], 'models',f'{model[1]}.hdf5') for model in model_ranks]
+    models['wd_nn'] = fuse_networks([os.path.join(models['wd_nn'], 'models',f'{model[1]}.hdf5') for model in model_ranks], n_features)
     logging.info('\n')
 
+    # run the neural network ensembles with onnx runtime if requested
+    if params.onnx or params.trt:
+
+        logging.info(f'Running NN Models with {"TensorRT" if params.trt else "ONNX Runtime"}\n')
+        models['ff_nn'] = onnx_networks(models['ff_nn'], n_features, params.trt, max_batch_size)
+        models['wd_nn'] = onnx_networks(models['wd_nn'], n_features, params.trt, max_batch_size)
+
     if params.pose_1:
 
         logging.info('Calculating scores for first pose only in pdbqt file(s)\n')
@@ -1104,43 +1285,90 @@ def score_ligand_batch(params, ligand_batch, model_binaries):
     Outputs:   Dataframe of scores and stats for ligands in the batch
     """
 
-    # multiprocess the extracting of features from the protein ligand pairs
-    with tqdm_joblib(tqdm(desc="Preparing features", total=len(ligand_batch))) as progress_bar:
-        multi_pose_features = Parallel(n_jobs=params.threads)(delayed(prepare_features)(ligand) for ligand in ligand_batch)
+    # skip feature extraction and scoring entirely if there
+    # are no poses in the batch, keeping the score columns as
+    # float32 so concatenating with scored batches can't make
+    # them object columns
+    if len(ligand_batch) == 0:
+        return pd.DataFrame({'Receptor': pd.Series(dtype=object),
+                             'SCORCH_pose_score': pd.Series(dtype=np.float32),
+                             'SCORCH_certainty': pd.Series(dtype=np.float32),
+                             'Ligand_ID': pd.Series(dtype=object),
+                             'Pose_Number': pd.Series(dtype=object)})
+
+    # send the poses to the workers in a few large batches rather
+    # than one at a time to cut down on the inter process overhead
+    batch_size = max(1, len(ligand_batch) // (4 * params.threads))
+
+    # make a memory mapped array shared with the workers, which
+    # joblib passes by reference, for each pose's features to be
+    # written into by row. The backing file is unique to this call
+    # so concurrent runs can't overwrite each other's rows, and is
+    # kept in memory on /dev/shm (unless joblib's temp folder is set)
+    # only if it has room for the whole array, as the file is sparse
+    # and running out of space part way through kills the workers
+    feature_store_size = len(ligand_batch) * len(headers_58) * np.dtype(np.float32).itemsize
+    temp_folder = os.environ.get('JOBLIB_TEMP_FOLDER')
+    if temp_folder is None and os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        shm_stats = os.statvfs('/dev/shm')
+        if shm_stats.f_bavail * shm_stats.f_frsize > feature_store_size:
+            temp_folder = '/dev/shm'
+    feature_store_fd, feature_store_path = tempfile.mkstemp(prefix='scorch_features_', suffix='.mmap', dir=temp_folder)
+    os.close(feature_store_fd)
+
+    try:
+        feature_store = np.memmap(feature_store_path, dtype=np.float32, mode='w+', shape=(len(ligand_batch), len(headers_58)))
+
+        # multiprocess the extracting of features from the protein ligand pairs
+        with tqdm_joblib(tqdm(desc="Preparing features", total=len(ligand_batch))) as progress_bar:
+            multi_pose_info = Parallel(n_jobs=params.threads, batch_size=batch_size)(delayed(prepare_features)(ligand, feature_store, row_index) for row_index, ligand in enumerate(ligand_batch))
 
-    # concatenate all the produced features
-    multi_pose_features = pd.concat(multi_pose_features)
+        # scale the features into a normal array
+        receptors, ligands = zip(*multi_pose_info)
+        features = scale_multipose_features(feature_store)
+        del feature_store
 
-    # scale the features
-    multi_pose_features = scale_multipose_features(multi_pose_features)
+    # make sure the memory mapped file is deleted even if a worker fails
+    finally:
+        os.remove(feature_store_path)
+
+    # then build the model input and the ligand and receptor info
+    # dataframes once to share between all the models
+    multi_pose_features = pd.DataFrame(features, columns=headers_58)
+    ligand_info = pd.DataFrame({'Ligand': ligands, 'Receptor': receptors})
 
     # load the models
     models = [(m[0], m[1]) for m in model_binaries]
 
-    model_results = list()
-
     logging.info('**************************************************************************\n')
 
-    # score the features and add dataframe of results to list
-    for model in models:
-        model_results.append(score(model, multi_pose_features))
-        logging.info('Done!')
+    # score the features with all the models at once in threads, as
+    # xgboost and tensorflow release the GIL while predicting, and
+    # get the dataframes of results as a list in model order
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        model_results = list(executor.map(partial(score, features=multi_pose_features, ligand_info=ligand_info), models))
+    logging.info('Done!')
 
     logging.info('**************************************************************************\n')
 
-    # merge the results into one dataframe
-    merged_results = reduce(lambda x, y: pd.merge(x, y, on = ['Receptor','Ligand']), model_results)
+    # every model scored the same rows in the same order, so join the
+    # prediction columns side by side instead of merging on the names
+    assert all(results.index.equals(model_results[0].index) for results in model_results)
+    merged_results = pd.concat([model_results[0]] + [results.drop(columns=['Receptor','Ligand']) for results in model_results[1:]], axis=1, copy=False)
 
-    # create main scorch score by taking mean of model scores
+    # get the model scores as a single array
     multi_models = ['xgboost_model',
                     'ff_nn_models_average',
                     'wd_nn_models_average']
-    merged_results['SCORCH_pose_score'] = merged_results[multi_models].mean(axis=1)
+    model_scores = merged_results[multi_models].to_numpy(dtype=np.float32)
+
+    # create main scorch score by taking mean of model scores
+    merged_results['SCORCH_pose_score'] = model_scores.mean(axis=1)
 
     # calculate scorch certainty score
     max_std = 0.4714 # result from [0, 0, 1] or [1, 1, 0]
     minimum_val = 1 - max_std
-    merged_results['SCORCH_stdev'] = merged_results[multi_models].std(axis=1, ddof=0)
+    merged_results['SCORCH_stdev'] = model_scores.std(axis=1, ddof=0)
     merged_results['SCORCH_certainty'] = ((1-merged_results['SCORCH_stdev'])-minimum_val)/max_std
 
     # subset only columns we want
@@ -1211,6 +1439,10 @@ def scoring(params):
     # print help/intro if requested
     print_intro(params)
 
+    # drop any receptors parsed by an earlier run in this process
+    binana.parse_receptor.cache_clear()
+    ParseProteinAsDF.cache_clear()
+
     # prepare and dock smiles if smiles ligands supplied
     if params.dock:
 
@@ -1233,8 +1465,9 @@ def scoring(params):
     # calculate pose indexes to score in each batch
     ligand_batch_indexes = list_to_chunk_indexes(total_poses, batches_needed)
 
-    # prepare the models
-    model_dict = prepare_models(params)
+    # prepare the models for the largest batch of poses
+    max_batch_size = max([1] + [end - start for start, end in ligand_batch_indexes])
+    model_dict = prepare_models(params, max_batch_size)
     model_binaries = list(model_dict.items())
 
     # empty list for scores from each batch
@@ -1257,8 +1490,10 @@ def scoring(params):
         # score the batch and get the results
         merged_results = score_ligand_batch(params, ligand_batch, model_binaries)
 
-        # add the results to the ligand_scores list
-        ligand_scores.append(merged_results)
+        # add the results to the ligand_scores list, leaving out
+        # empty batches unless nothing else has been scored
+        if len(merged_results) or not ligand_scores:
+            ligand_scores.append(merged_results)
 
     # make final results from ligand scores
     final_ligand_scores = create_final_results(params, ligand_scores)
@@ -17,6 +17,7 @@ import __future__
 
 import math
 import os
+import functools
 import sys
 import textwrap
 import json
@@ -2490,10 +2491,47 @@ Class Binana
 """
 
 
+# Load a receptor and assign its secondary structure. The receptor is the same for
+# every ligand scored against it and is only read, so each version of the file is only
+# parsed once per process, with its modification time and size in the cache key so a
+# receptor rewritten at the same path is parsed again.
+# Param receptor_pdbqt_filename (string)
+def load_receptor(receptor_pdbqt_filename):
+    receptor_stat = os.stat(receptor_pdbqt_filename)
+    return parse_receptor(receptor_pdbqt_filename, receptor_stat.st_mtime, receptor_stat.st_size)
+
+
+# Param receptor_pdbqt_filename (string), receptor_mtime (float), receptor_size (int)
+@functools.lru_cache(maxsize=None)
+def parse_receptor(receptor_pdbqt_filename, receptor_mtime, receptor_size):
+    receptor = PDB()
+    receptor.load_PDB(receptor_pdbqt_filename)
+    receptor.assign_secondary_structure()
+    return receptor
+
+
 class Binana:
 
     functions = MathFunctions()
 
+    # fixed parameters, only read while scoring so shared by every instance
+    parameters = {'close_contacts_dist1_cutoff': 2.5,
+                  'close_contacts_dist2_cutoff': 4.0, 
+                  'electrostatic_dist_cutoff': 4.0, 
+                  'active_site_flexibility_dist_cutoff': 4.0, 
+                  'hydrophobic_dist_cutoff': 4.0, 
+                  'hydrogen_bond_dist_cutoff': 4.0, 
+                  'hydrogen_bond_angle_cutoff': 40.0, 
+                  'pi_padding_dist': 0.75, 
+                  'pi_pi_interacting_dist_cutoff': 7.5, 
+                  'pi_stacking_angle_tolerance': 30.0, 
+                  'T_stacking_angle_tolerance': 30.0, 
+                  'T_stacking_closest_dist_cutoff': 5.0, 
+                  'cation_pi_dist_cutoff': 6.0, 
+                  'salt_bridge_dist_cutoff': 5.5,  
+                  'output_dir': '', 
+                  'output_file': ''}
+
     # supporting functions
     def list_alphebetize_and_combine(self, list_obj):
         list_obj.sort()
@@ -2517,30 +2555,12 @@ class Binana:
     # The meat of the class
     def __init__(self, ligand_pdbqt_filename, receptor_pdbqt_filename):
 
-
-        parameters = {'close_contacts_dist1_cutoff': 2.5,
-                      'close_contacts_dist2_cutoff': 4.0, 
-                      'electrostatic_dist_cutoff': 4.0, 
-                      'active_site_flexibility_dist_cutoff': 4.0, 
-                      'hydrophobic_dist_cutoff': 4.0, 
-                      'hydrogen_bond_dist_cutoff': 4.0, 
-                      'hydrogen_bond_angle_cutoff': 40.0, 
-                      'pi_padding_dist': 0.75, 
-                      'pi_pi_interacting_dist_cutoff': 7.5, 
-                      'pi_stacking_angle_tolerance': 30.0, 
-                      'T_stacking_angle_tolerance': 30.0, 
-                      'T_stacking_closest_dist_cutoff': 5.0, 
-                      'cation_pi_dist_cutoff': 6.0, 
-                      'salt_bridge_dist_cutoff': 5.5,  
-                      'output_dir': '', 
-                      'output_file': ''}
+        parameters = self.parameters
 
         ligand = PDB()
         ligand.load_PDB(ligand_pdbqt_filename)
 
-        receptor = PDB()
-        receptor.load_PDB(receptor_pdbqt_filename)
-        receptor.assign_secondary_structure()
+        receptor = load_receptor(receptor_pdbqt_filename)
 
         # Get distance measurements between protein and ligand atom types, as
         # well as some other measurements
@@ -2552,7 +2572,7 @@ class Binana:
         hbonds = {}
         hydrophobics = {}
 
-        functions = MathFunctions()
+        functions = self.functions
 
         pdb_close_contacts = PDB()
         pdb_contacts = PDB()
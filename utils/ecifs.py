@@ -15,6 +15,7 @@ import numpy as np
 import pandas as pd
 import os
 from os import listdir
+from functools import lru_cache
 from rdkit import Chem
 from scipy.spatial.distance import cdist
 from itertools import product
@@ -536,12 +537,21 @@ def LoadPDBasDF(PDB):
         print("WARNING: Protein contains unsupported atom types. Only supported atom-type pairs are counted.")
     return(df)
 
-def GetPLPairs(PDB_protein, SDF_ligand, distance_cutoff):
-# This function returns the protein-ligand atom-type pairs for a given distance cutoff
+def LoadProteinAsDF(protein):
+# This function takes a pdbqt filepath for a protein and returns it as a pandas DataFrame with its atom types labeled
+# according to ECIF, reusing an earlier parse while the file is unchanged
+
+    protein_stat = os.stat(protein)
+    return ParseProteinAsDF(protein, protein_stat.st_mtime, protein_stat.st_size)
+
+@lru_cache(maxsize=None)
+def ParseProteinAsDF(protein, protein_mtime, protein_size):
+# Cached parse for LoadProteinAsDF, the file's modification time and size are only part of the cache key
 
-    # Load both structures as pandas DataFrames
-    Target = LoadPDBasDF(PDB_protein)
-    Ligand = LoadSDFasDF(SDF_ligand)
+    return LoadPDBasDF(PDB(protein))
+
+def GetPLAtoms(Target, Ligand, distance_cutoff):
+# This function returns the protein and ligand atoms that can form pairs for a given distance cutoff
 
     # Take all atoms from the target within a cubic box around the ligand considering the "distance_cutoff criterion"
     for i in ["X","Y","Z"]:
@@ -552,6 +562,14 @@ def GetPLPairs(PDB_protein, SDF_ligand, distance_cutoff):
     Target = Target.loc[Target.ECIF_ATOM_TYPE.isin(exhaustive_Protein_Atoms)]
     Ligand = Ligand.loc[Ligand.ECIF_ATOM_TYPE.isin(exhaustive_Ligand_Atoms)]
 
+    return Target, Ligand
+
+def GetPLPairs(PDB_protein, SDF_ligand, distance_cutoff):
+# This function returns the protein-ligand atom-type pairs for a given distance cutoff
+
+    # Load both structures as pandas DataFrames and keep the atoms that can form pairs
+    Target, Ligand = GetPLAtoms(LoadPDBasDF(PDB_protein), LoadSDFasDF(SDF_ligand), distance_cutoff)
+
     # Get all possible pairs
     Pairs = list(product(Target["ECIF_ATOM_TYPE"], Ligand["ECIF_ATOM_TYPE"]))
     Pairs = [x[0]+"-"+x[1] for x in Pairs]
@@ -570,12 +588,24 @@ def GetPLPairs(PDB_protein, SDF_ligand, distance_cutoff):
     # Pairs["ELEMENTS_PAIR"] = [x.split("-")[0].split(";")[0]+"-"+x.split("-")[1].split(";")[0] for x in Pairs["ECIF_PAIR"]]
     return Pairs
 
+# Positions of the protein and ligand atom types, so that the pair of the i-th protein
+# atom type and j-th ligand atom type is PossibleECIF[i*len(ECIF_LigandAtoms)+j]
+ECIF_ProteinAtomIndex = {atom: i for i, atom in enumerate(ECIF_ProteinAtoms)}
+ECIF_LigandAtomIndex = {atom: i for i, atom in enumerate(ECIF_LigandAtoms)}
+
 def GetECIF(protein, ligand, distance_cutoff):
 # Main function for the calculation of ECIF
     SDF_ligand = SDF(ligand)
-    PDB_protein = PDB(protein)
-    Pairs = GetPLPairs(PDB_protein, SDF_ligand, distance_cutoff=distance_cutoff)
-    ECIF = [list(Pairs["ECIF_PAIR"]).count(x) for x in PossibleECIF]
+    Target, Ligand = GetPLAtoms(LoadProteinAsDF(protein), LoadSDFasDF(SDF_ligand), distance_cutoff=distance_cutoff)
+
+    # Get the PossibleECIF index of every protein-ligand atom pair
+    Target_Index = Target["ECIF_ATOM_TYPE"].map(ECIF_ProteinAtomIndex).to_numpy().astype(np.int64)
+    Ligand_Index = Ligand["ECIF_ATOM_TYPE"].map(ECIF_LigandAtomIndex).to_numpy().astype(np.int64)
+    Pair_Index = Target_Index[:, None]*len(ECIF_LigandAtoms) + Ligand_Index[None, :]
+
+    # calculate distances and count the pairs within the cutoff
+    Distances = cdist(Target[["X","Y","Z"]], Ligand[["X","Y","Z"]], metric="euclidean")
+    ECIF = np.bincount(Pair_Index[Distances <= distance_cutoff], minlength=len(PossibleECIF))
 
     return ECIF
 